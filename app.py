@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 from pathlib import Path
 import time
-import json
+import os
 
 # Import the refactored functions from the modules
 from modules import scheme_processing, ocr_processing, scoring
@@ -21,6 +21,17 @@ st.set_page_config(page_title="Automated Answer Grader", page_icon="🤖", layou
 st.title("🤖 Automated Answer Grader")
 st.markdown("An intelligent system to parse, evaluate, and score student answers using AI.")
 
+# Load the models once per server process so "Start Grading" does not wait on them.
+# A failure here only warns; the step that needs the model will load it (or fail) later.
+with st.spinner("Warming models..."):
+    for label, warm_up in [("EasyOCR reader", ocr_processing._get_ocr_reader),
+                           ("embedding model", scheme_processing._get_embedding_model),
+                           ("Ollama model", scoring.warm_up_ollama)]:
+        try:
+            warm_up()
+        except Exception as e:
+            st.warning(f"Could not preload the {label}: {e}")
+
 # --- Helper function for styling the results dataframe ---
 def style_confidence(val):
     try:
@@ -32,6 +43,25 @@ def style_confidence(val):
     except (ValueError, TypeError):
         return ''
 
+# --- Helper function to find existing input files in one directory pass ---
+@st.cache_data(ttl=5)
+def _scan_uploads(uploads_dir: str, mtime_ns: int):
+    """
+    Returns (scheme_pdf, student_pdf, coords_json) paths found in `uploads_dir`.
+    `mtime_ns` is only part of the cache key, so adding a file invalidates it.
+    """
+    scheme = student = coords = None
+    with os.scandir(uploads_dir) as it:
+        for entry in it:
+            name = entry.name.lower()
+            if name.endswith('.pdf') and 'scheme' in name:
+                scheme = scheme or Path(entry.path)
+            elif name.endswith('.pdf') and 'answers' in name:
+                student = student or Path(entry.path)
+            elif name.endswith('.json') and 'coords' in name:
+                coords = coords or Path(entry.path)
+    return scheme, student, coords
+
 # --- 3. SIDEBAR FOR FILE UPLOADS AND CONTROLS ---
 with st.sidebar:
     st.header("Setup")
@@ -48,9 +78,8 @@ with st.sidebar:
     st.markdown("Upload files, or place them in the `data/uploads` folder and refresh.")
     
     # Check for existing files
-    existing_scheme_pdf = next(UPLOADS_DIR.glob('*scheme*.pdf'), None)
-    existing_student_pdf = next(UPLOADS_DIR.glob('*answers*.pdf'), None)
-    existing_coords_json = next(UPLOADS_DIR.glob('*coords*.json'), None)
+    existing_scheme_pdf, existing_student_pdf, existing_coords_json = \
+        _scan_uploads(str(UPLOADS_DIR), UPLOADS_DIR.stat().st_mtime_ns)
 
     if existing_scheme_pdf and existing_student_pdf and existing_coords_json:
         st.success("Found existing files! Ready to grade.")
@@ -70,6 +99,13 @@ with st.sidebar:
     
     st.markdown("---")
     st.header("Advanced")
+    ocr_workers = st.number_input(
+        "EasyOCR workers", min_value=1, max_value=os.cpu_count() or 1, value=1,
+        help="Number of processes used for OCR. Each worker loads its own EasyOCR model on the first "
+             "run with that setting; the pool is then kept until the cache is cleared. "
+             "For short PDFs a single worker is usually fastest."
+    )
+    save_crops = st.checkbox("Save cropped images (debug)", value=False)
     if st.button("Clear Cache and Reset", use_container_width=True):
         st.cache_data.clear()
         st.cache_resource.clear()
@@ -107,18 +143,16 @@ if start_button:
 
         # --- B. Execute the Grading Pipeline ---
         main_status.write("Step 1/3: Processing the marking scheme...")
-        raw_scheme_text = scheme_processing.process_scheme(scheme_pdf_path, SCHEME_ARTIFACTS_DIR)
+        raw_scheme_text, scheme_meta = scheme_processing.process_scheme(scheme_pdf_path, SCHEME_ARTIFACTS_DIR)
+        st.session_state["scheme_meta"] = scheme_meta
         st.write("✅ Marking scheme parsed and vector index built.")
         
         with st.expander("Sanity Check: Review Parsed Marking Scheme"):
             col1, col2 = st.columns(2)
             with col1:
                 st.subheader("Parsed Scheme Data")
-                meta_path = SCHEME_ARTIFACTS_DIR / "scheme_meta.jsonl"
-                if meta_path.exists():
-                    points = [json.loads(line) for line in open(meta_path, 'r', encoding='utf8')]
-                    scheme_df = pd.DataFrame(points)
-                    st.dataframe(scheme_df, use_container_width=True, height=300)
+                scheme_df = pd.DataFrame(st.session_state["scheme_meta"])
+                st.dataframe(scheme_df, use_container_width=True, height=300)
             with col2:
                 st.subheader("Raw Extracted Text from PDF")
                 st.text_area("Raw Text", raw_scheme_text, height=300)
@@ -127,7 +161,8 @@ if start_button:
 
         main_status.write("Step 2/3: Processing student answers (Cropping & OCR)...")
         student_csv_path = STUDENT_ARTIFACTS_DIR / "students_ocr.csv"
-        ocr_processing.process_student_pdf(student_pdf_path, coords_json_path, STUDENT_ARTIFACTS_DIR, student_csv_path)
+        ocr_processing.process_student_pdf(student_pdf_path, coords_json_path, STUDENT_ARTIFACTS_DIR, student_csv_path,
+                                          ocr_workers=int(ocr_workers), save_crops=save_crops)
         st.write("✅ Student answers PDF cropped and text extracted via OCR.")
 
         with st.expander("Sanity Check: Review Extracted Student Answers"):
@@ -140,7 +175,8 @@ if start_button:
         main_status.write(f"Step 3/3: Scoring answers with AI...")
         model_info_placeholder = st.empty()
         final_scores_path = RESULTS_DIR / "final_scores.csv"
-        scoring.score_answers(student_csv_path, SCHEME_ARTIFACTS_DIR, final_scores_path, model_info_placeholder)
+        scoring.score_answers(student_csv_path, SCHEME_ARTIFACTS_DIR, final_scores_path, model_info_placeholder,
+                              meta=st.session_state["scheme_meta"])
         st.write("✅ LLM scoring complete.")
         
         main_status.update(label="Grading Pipeline Complete!", state="complete", expanded=False)
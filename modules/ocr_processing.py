@@ -1,113 +1,278 @@
-import json
+import orjson
+import asyncio
 import cv2
 import numpy as np
 import fitz  # PyMuPDF
-import os
 import re
 import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import easyocr
 import streamlit as st
 
 # --- Part 1: Functions from save_cropped_images.py ---
 
-def _crop_and_save_images(pdf_path: Path, coords_path: Path, output_dir: Path):
-    """
-    Crops a PDF based on JSON coordinates and saves the images.
-    """
-    # Ensure the output directory for cropped images exists
-    cropped_images_dir = output_dir / "cropped_images"
-    cropped_images_dir.mkdir(exist_ok=True)
-    
-    with open(coords_path, "r") as f:
-        coords = json.load(f)
-
-    doc = fitz.open(pdf_path)
-    
-    # Process only the first page as per the original script's logic
-    if doc.page_count > 0:
-        page_num = 0
-        page = doc[page_num]
-        
-        pix = page.get_pixmap(dpi=200)
-        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-        
-        if pix.n == 4: # RGBA
-            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
-        elif pix.n == 3: # RGB
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-
-        for q_num, regions in coords.items():
-            for region_type, (pt1, pt2) in regions.items():
-                x_min, x_max = min(pt1[0], pt2[0]), max(pt1[0], pt2[0])
-                y_min, y_max = min(pt1[1], pt2[1]), max(pt1[1], pt2[1])
-                
-                cropped_img = img[y_min:y_max, x_min:x_max]
-                
-                crop_filename = f"Pair{q_num}_{region_type}_page{page_num}.png"
-                crop_path = cropped_images_dir / crop_filename
-                cv2.imwrite(str(crop_path), cropped_img)
-    
-    doc.close()
-    return cropped_images_dir
+# box_coords.json is captured on a 200 DPI render (see others/capture_coords.py);
+# pages are rendered at a lower DPI and the coordinates scaled to match.
+COORDS_DPI = 200
+RENDER_DPI = 150
+# Debug crops are JPEG: OpenCV's wheels encode through SIMD libjpeg-turbo, far cheaper than
+# zlib-compressed PNG. Huffman optimisation is skipped since it costs an extra pass.
+CROP_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 92, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+
+def _load_coords(coords_path: Path):
+    """Loads the {q_id: {region_type: [pt1, pt2]}} box coordinates."""
+    return orjson.loads(Path(coords_path).read_bytes())
+
+def _crop_page(page, coords: dict, page_num: int, save_dir: Path = None):
+    """
+    Renders one PDF page and crops it based on the coordinates.
+    Returns {q_id: {region_type: ndarray}} in coordinate-file order. The crops are
+    only written to `save_dir` (as JPEGs) when one is given, for debugging.
+    """
+    # Plain RGB without alpha: always 3 channels, no full-page colour conversion needed.
+    # samples_mv points straight at MuPDF's buffer (pix.samples would copy the whole page),
+    # so `img` is only valid while `pix` is alive.
+    pix = page.get_pixmap(dpi=RENDER_DPI, colorspace=fitz.csRGB, alpha=False)
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+    scale = RENDER_DPI / COORDS_DPI
+
+    crops = {}
+    for q_num, regions in coords.items():
+        crops[q_num] = {}
+        for region_type, (pt1, pt2) in regions.items():
+            x_min, x_max = min(pt1[0], pt2[0]), max(pt1[0], pt2[0])
+            y_min, y_max = min(pt1[1], pt2[1]), max(pt1[1], pt2[1])
+            x_min, x_max = round(x_min * scale), round(x_max * scale)
+            y_min, y_max = round(y_min * scale), round(y_max * scale)
+            
+            # Copy just the region out of the pixmap; EasyOCR takes the RGB array as-is
+            cropped_img = img[y_min:y_max, x_min:x_max].copy()
+            crops[q_num][region_type] = cropped_img
+
+            if save_dir is not None:
+                # Only the small crop is flipped RGB -> BGR for OpenCV
+                crop_path = save_dir / f"Pair{q_num}_{region_type}_page{page_num}.jpg"
+                cv2.imwrite(str(crop_path), cropped_img[:, :, ::-1], CROP_JPEG_PARAMS)
+    del img, pix
+    return crops
 
 # --- Part 2: Functions from printed_ocr.py ---
 
+DIGITS_RE = re.compile(r'\d+')
+
+# Typical (width, height) of the number and answer batches, used to warm up the reader
+NUMBER_BATCH_SIZE = (256, 128)
+ANSWER_BATCH_SIZE = (1024, 256)
+
 @st.cache_resource
-def _get_ocr_reader():
-    """Loads and caches the EasyOCR reader."""
-    return easyocr.Reader(['en'], gpu=False)
+def _get_ocr_reader(gpu=False):
+    """Loads, warms up and caches the EasyOCR reader."""
+    reader = easyocr.Reader(['en'], gpu=gpu, cudnn_benchmark=True)
+    # Dummy runs of both code paths so cuDNN picks its kernels before real work arrives
+    num_width, num_height = NUMBER_BATCH_SIZE
+    reader.recognize(np.zeros((num_height, num_width), np.uint8),
+                     horizontal_list=[[0, num_width, 0, num_height]], free_list=[], allowlist='0123456789')
+    ans_width, ans_height = ANSWER_BATCH_SIZE
+    reader.readtext_batched(np.zeros((1, ans_height, ans_width, 3), np.uint8), n_width=ans_width, n_height=ans_height)
+    return reader
 
-def _run_ocr_on_images(images_dir: Path, output_csv_path: Path):
+# Per-process reader used by the OCR worker pool (set by _init_worker_reader)
+_WORKER_READER = None
+
+def _init_worker_reader():
+    """Pool initializer: loads one EasyOCR reader per worker process."""
+    global _WORKER_READER
+    _WORKER_READER = easyocr.Reader(['en'], gpu=False)
+
+@st.cache_resource(max_entries=1)
+def _get_ocr_pool(workers: int):
     """
-    Runs OCR on the cropped images and saves the results to a CSV file.
+    Creates and caches the OCR worker pool, so the worker processes (and their
+    readers) survive across grading runs instead of reloading torch each time.
     """
-    reader = _get_ocr_reader()
-    
-    # Find all cropped image pairs
-    image_files = os.listdir(images_dir)
-    question_ids = sorted(list(set([re.search(r'Pair(\d+)', f).group(1) for f in image_files if re.search(r'Pair(\d+)', f)])))
+    # "spawn" keeps the workers independent of Streamlit's threads and torch state
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker_reader)
 
-    with open(output_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(['student_id', 'question_id', 'answer_text'])
-        
-        student_id = 'S_01' # Default student ID for this run
+# The pool handed out last; shut down once the cache hands out a different one
+_active_ocr_pool = None
 
-        for q_id in question_ids:
-            num_file = images_dir / f"Pair{q_id}_number_page0.png"
-            ans_file = images_dir / f"Pair{q_id}_answer_page0.png"
-            
-            if num_file.exists() and ans_file.exists():
-                try:
-                    # OCR for question number (though we already have it)
-                    # This part could be simplified if q_id is trusted
-                    number_results = reader.readtext(str(num_file))
-                    full_number_text = ' '.join([res[1] for res in number_results])
-                    match = re.search(r'\d+', full_number_text)
-                    question_id_ocr = match.group(0) if match else q_id
+def _ocr_pool(workers: int):
+    """Returns the cached pool for `workers`, shutting down any previous pool's processes."""
+    global _active_ocr_pool
+    pool = _get_ocr_pool(workers)
+    if _active_ocr_pool is not None and _active_ocr_pool is not pool:
+        _active_ocr_pool.shutdown(wait=False, cancel_futures=True)
+    _active_ocr_pool = pool
+    return pool
+
+def _stack_crops(images):
+    """
+    Copies same-type crops into one contiguous (N, Hmax, Wmax, 3) buffer,
+    padding with white (the page background) on the right and bottom.
+    """
+    h_max = max(img.shape[0] for img in images)
+    w_max = max(img.shape[1] for img in images)
+    batch = np.full((len(images), h_max, w_max, 3), 255, dtype=np.uint8)
+    for i, img in enumerate(images):
+        batch[i, :img.shape[0], :img.shape[1]] = img
+    return batch
+
+# Pixels of padding kept around the ink when tightening a number box
+NUMBER_BOX_MARGIN = 4
+# Below this recognizer confidence the number read is ignored in favour of the coords' q_id
+NUMBER_MIN_CONFIDENCE = 0.5
+
+def _read_numbers(reader, images):
+    """
+    Reads the question-number crops without running the CRAFT text detector.
+    The padded crops are binarized and stacked into one tall strip; each crop's
+    box is tightened to its ink so the digits keep their size when the recognizer
+    rescales the line, and recognition is restricted to digits.
+    Returns one (text, confidence) pair per crop; ('', 0.0) when nothing was read.
+    """
+    batch = _stack_crops(images)
+    n, h, w, _ = batch.shape
+    grey = cv2.cvtColor(batch.reshape(n * h, w, 3), cv2.COLOR_RGB2GRAY)
+    _, binary = cv2.threshold(grey, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    boxes = []
+    for i in range(n):
+        ink = cv2.findNonZero(255 - binary[i * h:(i + 1) * h])
+        if ink is None:   # blank cell
+            continue
+        x, y, bw, bh = cv2.boundingRect(ink)
+        boxes.append([
+            max(0, x - NUMBER_BOX_MARGIN), min(w, x + bw + NUMBER_BOX_MARGIN),
+            i * h + max(0, y - NUMBER_BOX_MARGIN), i * h + min(h, y + bh + NUMBER_BOX_MARGIN),
+        ])
 
-                    # OCR for answer text
-                    answer_results = reader.readtext(str(ans_file), paragraph=True)
-                    answer_text = ' '.join([res[1] for res in answer_results])
+    results = []
+    if boxes:
+        results = reader.recognize(binary, horizontal_list=boxes, free_list=[],
+                                   allowlist='0123456789', batch_size=len(boxes))
 
-                    csv_writer.writerow([student_id, question_id_ocr, answer_text])
-                except Exception as e:
-                    st.warning(f"Could not process OCR for Question ID {q_id}: {e}")
+    # Map each result back to its crop by the top edge of its box
+    texts = [('', 0.0)] * n
+    for box, text, confidence in results:
+        texts[int(box[0][1]) // h] = (text, float(confidence))
+    return texts
+
+def _ocr_question_batch(reader, items):
+    """
+    OCRs a list of (q_id, number_img, answer_img) items in batches.
+    Returns a list of (q_id, question_id_ocr, answer_text) in the same order.
+    """
+    number_texts = _read_numbers(reader, [num for _, num, _ in items])
+    # Answers span several lines, so they still go through the detector
+    ans_batch = _stack_crops([ans for _, _, ans in items])
+    ans_out = reader.readtext_batched(list(ans_batch), n_width=ans_batch.shape[2], n_height=ans_batch.shape[1], paragraph=True)
+
+    rows = []
+    for (q_id, _, _), (number_text, number_conf), answer_results in zip(items, number_texts, ans_out):
+        # OCR for question number (though we already have it)
+        # An uncertain read would score the answer against the wrong scheme, so trust q_id then
+        match = DIGITS_RE.search(number_text)
+        question_id_ocr = match.group(0) if match and number_conf >= NUMBER_MIN_CONFIDENCE else q_id
+
+        answer_text = ' '.join([res[1] for res in answer_results])
+        rows.append((q_id, question_id_ocr, answer_text))
+    return rows
+
+def _ocr_worker_task(items):
+    """Runs in a pool worker; uses that worker's own reader."""
+    return _ocr_question_batch(_WORKER_READER, items)
+
+async def _ocr_items(items, workers: int):
+    """
+    OCRs one page's (q_id, number_img, answer_img) items off the event loop:
+    in a thread with the cached reader, or split round-robin over the process pool.
+    A pool broken by a dead worker is replaced and the page retried once.
+    """
+    loop = asyncio.get_running_loop()
+    if workers <= 1:
+        return await loop.run_in_executor(None, _ocr_question_batch, _get_ocr_reader(), items)
+
+    n_chunks = min(workers, len(items))
+    chunks = [items[i::n_chunks] for i in range(n_chunks)]
+    try:
+        pool = _ocr_pool(workers)
+        chunk_rows = await asyncio.gather(*(loop.run_in_executor(pool, _ocr_worker_task, chunk) for chunk in chunks))
+    except BrokenProcessPool:
+        _get_ocr_pool.clear()
+        pool = _ocr_pool(workers)
+        chunk_rows = await asyncio.gather(*(loop.run_in_executor(pool, _ocr_worker_task, chunk) for chunk in chunks))
+    order = {q_id: i for i, (q_id, _, _) in enumerate(items)}
+    return sorted((row for rows in chunk_rows for row in rows), key=lambda row: order[row[0]])
+
+async def _process_pages(pdf_path: Path, coords: dict, save_dir: Path, workers: int):
+    """
+    Crops and OCRs every page as a producer/consumer pipeline: page N+1 is
+    rendered and cropped in a thread while page N is being OCR'd.
+    Each page is one student's sheet. Returns (student_id, question_id, answer_text) rows.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=2)
+    rows = []
+
+    async def produce():
+        with fitz.open(pdf_path) as doc:
+            for page_num in range(doc.page_count):
+                crops = await loop.run_in_executor(None, _crop_page, doc[page_num], coords, page_num, save_dir)
+                await queue.put((page_num, crops))
+        await queue.put(None)
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            page_num, crops = item
+            # Only questions with both a number and an answer box are OCR'd
+            items = [
+                (q_id, regions["number"], regions["answer"])
+                for q_id, regions in crops.items()
+                if "number" in regions and "answer" in regions
+            ]
+            if not items:
+                continue
+            try:
+                page_rows = await _ocr_items(items, workers)
+            except Exception as e:
+                st.warning(f"Could not process OCR for page {page_num + 1} (Question IDs {', '.join(q for q, _, _ in items)}): {e}")
+                continue
+            student_id = f"S_{page_num + 1:02d}"
+            rows.extend((student_id, question_id_ocr, answer_text) for _, question_id_ocr, answer_text in page_rows)
+
+    await asyncio.gather(produce(), consume())
+    return rows
+
+def _write_ocr_csv(rows, output_csv_path: Path):
+    """Saves the OCR rows to a CSV file."""
+    with open(output_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['student_id', 'question_id', 'answer_text'])
+        csv_writer.writerows(rows)
 
 
 # --- Main Orchestration Function ---
 
-def process_student_pdf(pdf_path: Path, coords_path: Path, student_artifacts_dir: Path, output_csv_path: Path):
+def process_student_pdf(pdf_path: Path, coords_path: Path, student_artifacts_dir: Path, output_csv_path: Path, ocr_workers: int = 1, save_crops: bool = False):
     """
-    Main function to process the student answer PDF.
-    It crops the PDF into images and then runs OCR on them.
+    Main function to process the student answer PDF (one student per page).
+    Each page is cropped into images that are OCR'd in memory, optionally across
+    `ocr_workers` processes. With `save_crops` the crops are also written to disk
+    for inspection.
     """
-    st.write("-> Cropping student answer sheet...")
-    cropped_images_dir = _crop_and_save_images(pdf_path, coords_path, student_artifacts_dir)
-    st.write(f"-> Saved cropped images to `{cropped_images_dir}`")
-    
-    st.write("-> Running OCR on cropped images...")
-    _run_ocr_on_images(cropped_images_dir, output_csv_path)
-    st.write(f"-> Saved OCR results to `{output_csv_path}`")
+    coords = _load_coords(coords_path)
+    save_dir = student_artifacts_dir / "cropped_images" if save_crops else None
+    if save_dir is not None:
+        save_dir.mkdir(exist_ok=True)
 
+    st.write("-> Cropping student answer pages and running OCR...")
+    rows = asyncio.run(_process_pages(pdf_path, coords, save_dir, ocr_workers))
+    if save_dir is not None:
+        st.write(f"-> Saved cropped images to `{save_dir}`")
+
+    _write_ocr_csv(rows, output_csv_path)
+    st.write(f"-> Saved OCR results to `{output_csv_path}`")
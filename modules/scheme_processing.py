@@ -1,27 +1,30 @@
-import json
+import orjson
 import re
-import pdfplumber
+import os
+import hashlib
+import fitz  # PyMuPDF
 from pathlib import Path
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import faiss
-from tqdm import tqdm
 import streamlit as st
 
 # --- Part 1: Functions from parse_scheme.py ---
 
+Q_SPLIT_RE = re.compile(r'(?m)^\s*(\d{1,3})\b')
+BULLET_RE = re.compile(r'\(\s*[ivxlcdm]+\s*\)', re.I)
+MARKS_RE = re.compile(r'(\d+)\s*[xX]\s*(\d+)\s*=\s*(\d+)')
+WS_RE = re.compile(r'\s+')
+
 def _extract_text_from_pdf(pdf_path):
     """Extracts all text from a given PDF file."""
-    text = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for p in pdf.pages:
-            page_text = p.extract_text(x_tolerance=2, y_tolerance=2) or ""
-            text.append(page_text)
-    return "\n\n".join(text)
+    # sort=True orders blocks top-to-bottom, left-to-right like pdfplumber did
+    with fitz.open(pdf_path) as doc:
+        return "\n\n".join(page.get_text("text", sort=True) for page in doc)
 
 def _split_questions(full_text):
     """Splits the full text into blocks based on question numbers."""
-    parts = re.split(r'(?m)^\s*(\d{1,3})\b', full_text)
+    parts = Q_SPLIT_RE.split(full_text)
     items = []
     for i in range(1, len(parts), 2):
         qid = parts[i].strip()
@@ -31,13 +34,13 @@ def _split_questions(full_text):
 
 def _split_points(qbody):
     """Splits a question body into individual marking points."""
-    bullets = re.split(r'\(\s*[ivxlcdm]+\s*\)', qbody, flags=re.I)
+    bullets = BULLET_RE.split(qbody)
     pts = [b.strip() for b in bullets if b.strip()]
     return pts
 
 def _detect_max_marks(qbody):
     """Detects mark allocation patterns like '3X1=3'."""
-    m = re.search(r'(\d+)\s*[xX]\s*(\d+)\s*=\s*(\d+)', qbody)
+    m = MARKS_RE.search(qbody)
     if m:
         total, parts, per = int(m.group(3)), int(m.group(1)), int(m.group(2))
         return total, parts, per
@@ -45,18 +48,108 @@ def _detect_max_marks(qbody):
 
 # --- Part 2: Functions from build_index.py ---
 
-def _load_points(path):
-    """Loads points from a JSONL file."""
-    pts = []
-    with open(path, 'r', encoding='utf8') as fh:
-        for line in fh:
-            pts.append(json.loads(line))
-    return pts
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
 @st.cache_resource
-def _get_embedding_model(model_name="sentence-transformers/all-MiniLM-L6-v2"):
-    """Loads and caches the sentence transformer model."""
-    return SentenceTransformer(model_name)
+def _get_embedding_model(model_name=EMBEDDING_MODEL_NAME):
+    """Loads and caches the sentence transformer model (in fp16 when running on a GPU)."""
+    model = SentenceTransformer(model_name)
+    # fp16 matmuls are slow or unsupported on most CPUs, so only halve the weights on GPU
+    if model.device.type == "cuda":
+        model.half()
+    return model
+
+def _encode(model, texts):
+    """Returns L2-normalized embeddings as float16; callers cast to float32 for FAISS."""
+    embeddings = model.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+    return embeddings.astype(np.float16)
+
+# --- Part 3: On-disk embedding cache ---
+# Normalized float16 embeddings of every point text seen so far, keyed by
+# sha1(model name + text), so re-processing a scheme only encodes the points that changed.
+
+EMB_CACHE_FILE = "embedding_cache.npy"
+EMB_CACHE_KEYS_FILE = "embedding_cache_keys.json"
+
+def _text_key(text, model_name=EMBEDDING_MODEL_NAME):
+    """Cache key for one text embedded with `model_name`."""
+    return hashlib.sha1(f"{model_name}\0{text}".encode("utf8")).hexdigest()
+
+def _load_embedding_cache(cache_dir: Path):
+    """Returns ({key: row}, memmapped embeddings) or ({}, None) if there is no usable cache."""
+    keys_path = cache_dir / EMB_CACHE_KEYS_FILE
+    emb_path = cache_dir / EMB_CACHE_FILE
+    if not (keys_path.exists() and emb_path.exists()):
+        return {}, None
+    try:
+        key_to_row = orjson.loads(keys_path.read_bytes())
+        embeddings = np.load(emb_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return {}, None
+    # Older caches held unnormalized float32 rows; start over rather than mix them in
+    if len(key_to_row) != embeddings.shape[0] or embeddings.dtype != np.float16:
+        return {}, None
+    return key_to_row, embeddings
+
+def _replace_atomically(path: Path, write):
+    """Writes via `write(fh)` to a temp file, then swaps it into place."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fh:
+        write(fh)
+    os.replace(tmp_path, path)
+
+def _encode_with_cache(model, texts, cache_dir: Path):
+    """Embeds `texts` in order (float16), running the model only on texts missing from the cache."""
+    key_to_row, cached = _load_embedding_cache(cache_dir)
+    keys = [_text_key(t) for t in texts]
+
+    # Unique texts not in the cache yet, in first-seen order
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in key_to_row and key not in missing:
+            missing[key] = text
+
+    if missing:
+        st.write(f"-> Encoding {len(missing)} new point(s), {len(texts) - len(missing)} cached...")
+        new_embeddings = _encode(model, list(missing.values()))
+        offset = 0 if cached is None else cached.shape[0]
+        all_embeddings = new_embeddings if cached is None else np.concatenate([cached, new_embeddings])
+        cached = None  # release the memmap before the file is replaced
+        for i, key in enumerate(missing):
+            key_to_row[key] = offset + i
+
+        _replace_atomically(cache_dir / EMB_CACHE_FILE, lambda fh: np.save(fh, all_embeddings))
+        _replace_atomically(cache_dir / EMB_CACHE_KEYS_FILE, lambda fh: fh.write(orjson.dumps(key_to_row)))
+    else:
+        st.write(f"-> All {len(texts)} point embeddings found in cache.")
+        all_embeddings = cached
+
+    # Fancy indexing copies the rows out of the memmap
+    return all_embeddings[[key_to_row[k] for k in keys]]
+
+# --- Part 4: Vector index ---
+
+# 8-bit PQ trains 256 centroids per sub-quantizer; faiss wants ~39 points per centroid
+IVFPQ_MIN_POINTS = 39 * 256
+PQ_SUBQUANTIZERS = 16
+HNSW_NEIGHBORS = 32
+
+def _build_index(embeddings):
+    """
+    Builds an inner-product index over L2-normalized float32 embeddings.
+    Large corpora get a product-quantized IVF index (16-byte codes instead of
+    d*4 bytes per vector); smaller ones, too few to train PQ codebooks, use HNSW.
+    """
+    n, d = embeddings.shape
+    if n >= IVFPQ_MIN_POINTS and d % PQ_SUBQUANTIZERS == 0:
+        nlist = min(64, n // 4)
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_SUBQUANTIZERS, 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    else:
+        index = faiss.IndexHNSWFlat(d, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+    index.add(embeddings)
+    return index
 
 # --- Main Orchestration Function ---
 
@@ -64,6 +157,7 @@ def process_scheme(pdf_path, output_dir: Path):
     """
     Main function to process the marking scheme PDF.
     It parses the PDF, creates embeddings, and saves the FAISS index and metadata.
+    Returns the raw extracted text and the metadata records (as in scheme_meta.jsonl).
     """
     st.write("-> Extracting text from marking scheme PDF...")
     full_text = _extract_text_from_pdf(pdf_path)
@@ -71,43 +165,42 @@ def process_scheme(pdf_path, output_dir: Path):
     st.write("-> Splitting text into questions and points...")
     questions = _split_questions(full_text)
     
+    # Serialize everything in memory and write each file with a single call
+    points, lines = [], []
+    for qid, body in questions:
+        pts = _split_points(body)
+        mark_info = _detect_max_marks(body)
+        per_point = 1
+        if mark_info:
+            _, _, per = mark_info
+            per_point = per if per > 0 else 1
+        
+        for idx, pt_text in enumerate(pts, start=1):
+            obj = {
+                "question_id": str(qid),
+                "point_index": idx,
+                "text": WS_RE.sub(' ', pt_text).strip(),
+                "marks": per_point
+            }
+            points.append(obj)
+            lines.append(orjson.dumps(obj) + b"\n")
+
     scheme_points_path = output_dir / "scheme_points.jsonl"
-    with scheme_points_path.open("w", encoding="utf8") as fh:
-        for qid, body in tqdm(questions, desc="Parsing Questions"):
-            pts = _split_points(body)
-            mark_info = _detect_max_marks(body)
-            per_point = 1
-            if mark_info:
-                _, _, per = mark_info
-                per_point = per if per > 0 else 1
-            
-            for idx, pt_text in enumerate(pts, start=1):
-                obj = {
-                    "question_id": str(qid),
-                    "point_index": idx,
-                    "text": re.sub(r'\s+', ' ', pt_text).strip(),
-                    "marks": per_point
-                }
-                fh.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    scheme_points_path.write_bytes(b"".join(lines))
 
     st.write(f"-> Saved {len(questions)} questions to scheme_points.jsonl.")
 
-    # Now, build the index from the generated file
+    # Now, build the index from the parsed points
     st.write("-> Building vector index from scheme points...")
-    points = _load_points(scheme_points_path)
     
     model = _get_embedding_model()
     
     texts = [p["text"] for p in points]
     
-    st.write("-> Encoding texts... (This might take a moment on first run)")
-    embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-    
-    faiss.normalize_L2(embeddings)
+    embeddings = _encode_with_cache(model, texts, output_dir)
     
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatIP(d)
-    index.add(embeddings.astype("float32"))
+    # Embeddings are already normalized; FAISS only takes float32
+    index = _build_index(embeddings.astype("float32"))
     
     # Define output paths
     index_path = output_dir / "scheme.index"
@@ -115,17 +208,20 @@ def process_scheme(pdf_path, output_dir: Path):
     meta_path = output_dir / "scheme_meta.jsonl"
     
     faiss.write_index(index, str(index_path))
-    np.save(emb_path, embeddings.astype("float32"))
+    np.save(emb_path, embeddings)
+    
+    scheme_meta, meta_lines = [], []
+    for i, meta in enumerate(points):
+        meta_rec = {
+            "fid": i,
+            "question_id": meta["question_id"],
+            "point_index": meta["point_index"],
+            "text": meta["text"],
+            "marks": meta.get("marks", 1)
+        }
+        scheme_meta.append(meta_rec)
+        meta_lines.append(orjson.dumps(meta_rec) + b"\n")
+    meta_path.write_bytes(b"".join(meta_lines))
     
-    with open(meta_path, 'w', encoding='utf8') as fh:
-        for i, meta in enumerate(points):
-            meta_rec = {
-                "fid": i,
-                "question_id": meta["question_id"],
-                "point_index": meta["point_index"],
-                "text": meta["text"],
-                "marks": meta.get("marks", 1)
-            }
-            fh.write(json.dumps(meta_rec, ensure_ascii=False) + "\n")
-            
     st.write("-> FAISS index, embeddings, and metadata saved successfully.")
+    return full_text, scheme_meta
@@ -1,78 +1,135 @@
-import json
-import pandas as pd
-import subprocess
+import orjson
+import asyncio
+import hashlib
+import numpy as np
+import faiss
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import requests
 from pathlib import Path
 import streamlit as st
-import re
+
+from modules import scheme_processing
 
 # --- Helper Functions ---
 
 def _load_meta(meta_path):
     """Loads metadata from a JSONL file."""
     meta = []
-    with open(meta_path, 'r', encoding='utf8') as fh:
+    with open(meta_path, 'rb') as fh:
         for line in fh:
-            meta.append(json.loads(line))
+            meta.append(orjson.loads(line))
     return meta
 
-def _ollama_chat_with_fallback(model_list, model_info_placeholder, prompt):
+OLLAMA_URL = "http://localhost:11434"
+OLLAMA_MODELS = ["mistral", "gemma:2b", "tinyllama"]
+OLLAMA_KEEP_ALIVE = "30m"   # keep the model resident between questions
+OLLAMA_CONCURRENCY = 4
+OLLAMA_TIMEOUT = 300
+
+class OllamaUnavailable(Exception):
+    """Raised when the Ollama server cannot be reached."""
+
+def _ollama_chat(session, model_name, messages):
     """
-    Tries to run Ollama with a list of models, falling back if a memory error occurs.
+    Sends one conversation to Ollama's /api/chat endpoint and returns the reply text.
+    Raises RuntimeError with Ollama's message if the request fails.
     """
-    for model_name in model_list:
+    payload = {
+        "model": model_name,
+        "messages": messages,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "format": "json",
+    }
+    try:
+        resp = session.post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=OLLAMA_TIMEOUT)
+    except requests.ConnectionError as e:
+        raise OllamaUnavailable(str(e)) from e
+    if resp.status_code != 200:
         try:
-            model_info_placeholder.info(f"Attempting to use model: `{model_name}`...")
-            cmd = ["ollama", "run", model_name]
-            proc = subprocess.Popen(
-                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                text=True, encoding='utf-8'
-            )
-            out, err = proc.communicate(prompt)
+            err = resp.json().get("error", resp.text)
+        except ValueError:
+            err = resp.text
+        raise RuntimeError(err)
+    return resp.json()["message"]["content"]
 
-            if proc.returncode != 0 and "memory" in err.lower():
-                st.warning(f"Model `{model_name}` requires more memory than available. Falling back...")
+def _ollama_chat_with_fallback(session, model_list, messages):
+    """
+    Tries the models in order, falling back if a model is missing or runs out of memory.
+    Returns (output, model_name, error). Runs off the Streamlit thread,
+    so it reports problems through the return value instead of st.*.
+    """
+    for model_name in model_list:
+        try:
+            return _ollama_chat(session, model_name, messages).strip(), model_name, None
+        except OllamaUnavailable:
+            raise
+        except RuntimeError as e:
+            # Unlike `ollama run`, the HTTP API does not pull missing models (404 "not found")
+            if "memory" in str(e).lower() or "not found" in str(e).lower():
                 continue
+            return None, model_name, f"Ollama Error with `{model_name}`: {e}"
+        except Exception as e:
+            return None, model_name, f"An unexpected error occurred with Ollama: {e}"
+    return None, None, "All attempted models failed. Please check your Ollama setup and available memory."
 
-            if proc.returncode != 0:
-                st.error(f"Ollama Error with `{model_name}`: {err}")
-                return None, model_name
+@st.cache_resource(show_spinner=False)
+def warm_up_ollama(model_list=tuple(OLLAMA_MODELS)):
+    """
+    Loads the first usable model into Ollama (an empty /api/generate request
+    with keep_alive) so the first scored answer does not pay the load time.
+    Returns the loaded model's name. Raises on failure, which st.cache_resource
+    does not cache, so a server started later is warmed on the next rerun.
+    """
+    for model_name in model_list:
+        try:
+            resp = requests.post(f"{OLLAMA_URL}/api/generate",
+                                 json={"model": model_name, "keep_alive": OLLAMA_KEEP_ALIVE},
+                                 timeout=OLLAMA_TIMEOUT)
+        except requests.RequestException as e:
+            raise OllamaUnavailable(f"Could not reach Ollama at {OLLAMA_URL}: {e}") from e
+        if resp.status_code == 200:
+            return model_name
+    raise RuntimeError(f"None of the Ollama models could be loaded: {', '.join(model_list)}")
 
-            model_info_placeholder.success(f"Successfully using model: `{model_name}`")
-            return out.strip(), model_name
+async def _run_prompts(session, model_list, prompts, on_done):
+    """
+    Sends the prompts (message lists) to Ollama concurrently (at most OLLAMA_CONCURRENCY in flight)
+    and returns their results in order. `on_done(i, result)` is called on the
+    calling thread as each one finishes.
+    """
+    semaphore = asyncio.Semaphore(OLLAMA_CONCURRENCY)
 
-        except FileNotFoundError:
-            st.error("Ollama command not found. Ensure Ollama is installed and in your system's PATH.")
-            st.stop()
-        except Exception as e:
-            st.error(f"An unexpected error occurred with Ollama: {e}")
-            return None, model_name
-    
-    st.error("All attempted models failed. Please check your Ollama setup and available memory.")
-    return None, None
+    async def run_one(i, prompt):
+        async with semaphore:
+            result = await asyncio.to_thread(_ollama_chat_with_fallback, session, model_list, prompt)
+        on_done(i, result)
+        return result
 
+    return await asyncio.gather(*(run_one(i, p) for i, p in enumerate(prompts)))
 
-def _build_prompt(question_id, scheme_points, student_answer):
-    """Builds a highly explicit structured prompt to prevent hallucination."""
+
+def _build_system_prompt(question_id, scheme_points):
+    """
+    Builds the per-question part of the prompt: instructions plus marking scheme.
+    It is identical for every student answering `question_id`, so Ollama can
+    reuse its cached prefix and only process the student's answer each time.
+    """
     scheme_text = "\n".join([f"- {pt['text']}" for pt in scheme_points])
     prompt = f"""
-<|SYSTEM|>
 You are an AI exam evaluator. Your task is to grade the student's answer based *only* on the provided marking scheme.
 - Compare the student's answer *only* against the text in the 'Marking Scheme' section.
 - Do not use any external knowledge.
 - Your entire response must be a single, valid JSON object.
-<|USER|>
+
 **Marking Scheme for Question {question_id}:**
 ---
 {scheme_text}
 ---
 
-**Student's Answer:**
----
-{student_answer}
----
-
 **Instructions:**
-Return a single JSON object with these exact keys:
+The student's answer follows in the next message. Return a single JSON object with these exact keys:
 - "marks_awarded": (integer) The total marks awarded based on the scheme.
 - "max_marks": (integer) The total possible marks for this question.
 - "confidence_score": (float, 0.0 to 1.0) Your confidence in the score.
@@ -82,34 +139,129 @@ Your response must start with {{ and end with }}.
 """
     return prompt.strip()
 
+def _build_messages(system_prompt, student_answer):
+    """Chat messages for one answer; the varying part comes last."""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"**Student's Answer:**\n---\n{student_answer}\n---"},
+    ]
+
 def _robust_json_parser(llm_output):
-    """A highly resilient parser for LLM JSON output."""
-    cleaned_output = re.sub(r'```json\s*|\s*```', '', llm_output).strip()
+    """Parses the LLM reply; Ollama's JSON mode guarantees it is a single JSON value."""
     typos = {'"marks_awaired"': '"marks_awarded"', '"confidence_scor"': '"confidence_score"'}
     for wrong, right in typos.items():
-        cleaned_output = cleaned_output.replace(wrong, right)
+        llm_output = llm_output.replace(wrong, right)
 
-    json_matches = re.findall(r'\{.*?\}', cleaned_output, re.DOTALL)
-    if not json_matches:
-        return {"error": "Parsing Failed", "details": "No JSON object found", "raw_output": llm_output}
+    try:
+        data = orjson.loads(llm_output)
+    except orjson.JSONDecodeError as e:
+        return {"error": "Parsing Failed", "details": str(e), "raw_output": llm_output}
+    if isinstance(data, dict) and "marks_awarded" in data and "justification" in data:
+        return data
+    return {"error": "Parsing Failed", "details": "The JSON object did not contain the required keys.", "raw_output": llm_output}
 
-    for match in json_matches:
-        try:
-            data = json.loads(match)
-            if isinstance(data, dict) and "marks_awarded" in data and "justification" in data:
-                return data
-        except json.JSONDecodeError:
+# --- Semantic Cache ---
+# Scored answers are kept per question (and per exact prompt and model, so editing the
+# scheme or switching models invalidates them) in a FAISS inner-product index over
+# normalized answer embeddings. Only results from the preferred model are stored, so a
+# fallback model's scores are never reused once the preferred one is available again.
+# A new answer whose cosine similarity to a scored one reaches the threshold reuses its result.
+
+SEMANTIC_CACHE_DIR = "semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_CONFIDENCE_FACTOR = 0.95   # reused scores are slightly less certain
+
+def _semantic_cache_paths(cache_dir: Path, question_id, system_prompt, model_name):
+    """Index and results paths for one question's cache of `model_name`'s results."""
+    tag = hashlib.sha1(f"{model_name}\0{system_prompt}".encode("utf8")).hexdigest()[:12]
+    base = cache_dir / f"q{question_id}_{tag}"
+    return base.with_suffix(".index"), base.with_suffix(".jsonl")
+
+def _load_semantic_cache(index_path: Path, results_path: Path, dim):
+    """Returns (faiss index, [res_json, ...]); empty if missing or inconsistent."""
+    if index_path.exists() and results_path.exists():
+        index = faiss.read_index(str(index_path))
+        cached_results = _load_meta(results_path)
+        if index.ntotal == len(cached_results) and index.d == dim:
+            return index, cached_results
+    return faiss.IndexFlatIP(dim), []
+
+def _save_semantic_cache(index, cached_results, index_path: Path, results_path: Path):
+    faiss.write_index(index, str(index_path))
+    results_path.write_bytes(b"".join(orjson.dumps(res_json) + b"\n" for res_json in cached_results))
+
+def _embed_answers(texts):
+    """Normalized float32 embeddings of the student answers."""
+    model = scheme_processing._get_embedding_model()
+    return scheme_processing._encode(model, texts).astype("float32")
+
+def _plan_with_semantic_cache(index, cached_results, embeddings):
+    """
+    Decides how each answer of one question gets its score. Returns a list of
+      ("cached", res_json)  close to an answer scored in an earlier run,
+      ("same_as", j)        close to answer j earlier in this batch,
+      ("score", None)       needs the LLM.
+    """
+    if index.ntotal:
+        sims, ids = index.search(embeddings, 1)
+    plan, to_score = [], []
+    for k, emb in enumerate(embeddings):
+        if index.ntotal and sims[k, 0] >= SEMANTIC_CACHE_THRESHOLD:
+            plan.append(("cached", cached_results[ids[k, 0]]))
             continue
-    return {"error": "Parsing Failed", "details": "Found JSON-like objects, but none contained the required keys.", "raw_output": llm_output}
+        if to_score:
+            batch_sims = embeddings[to_score] @ emb
+            best = int(np.argmax(batch_sims))
+            if batch_sims[best] >= SEMANTIC_CACHE_THRESHOLD:
+                plan.append(("same_as", to_score[best]))
+                continue
+        to_score.append(k)
+        plan.append(("score", None))
+    return plan
+
+def _reuse_result(res_json):
+    """Copy of a cached result with its confidence reduced."""
+    reused = dict(res_json)
+    try:
+        reused["confidence_score"] = round(float(reused.get("confidence_score", 0.0)) * SEMANTIC_CACHE_CONFIDENCE_FACTOR, 3)
+    except (TypeError, ValueError):
+        pass
+    return reused
 
 # --- Main Scoring Function ---
-def score_answers(student_csv_path: Path, scheme_artifacts_dir: Path, output_csv_path: Path, model_info_placeholder):
-    """Scores student answers using a direct lookup and an LLM with fallback."""
-    
-    ollama_model_list = ["mistral", "gemma:2b", "tinyllama"]
+# marks_awarded is a string column: besides numbers it can hold "N/A" or "Error"
+RESULT_SCHEMA = pa.schema([
+    ("student_id", pa.string()),
+    ("question_id", pa.string()),
+    ("marks_awarded", pa.string()),
+    ("max_marks", pa.int64()),
+    ("confidence_score", pa.float64()),
+    ("justification", pa.string()),
+])
+
+STUDENT_CSV_TYPES = {c: pa.string() for c in ("student_id", "question_id", "answer_text")}
 
-    meta = _load_meta(scheme_artifacts_dir / "scheme_meta.jsonl")
-    df = pd.read_csv(student_csv_path, dtype=str).fillna("")
+def _as_float(value):
+    """Best-effort float conversion for LLM-provided numbers."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def score_answers(student_csv_path: Path, scheme_artifacts_dir: Path, output_csv_path: Path, model_info_placeholder, meta=None):
+    """
+    Scores student answers using a direct lookup and an LLM with fallback.
+    `meta` is the scheme metadata from process_scheme; it is read from
+    scheme_meta.jsonl only when not given.
+    """
+    
+    if meta is None:
+        meta = _load_meta(scheme_artifacts_dir / "scheme_meta.jsonl")
+    # Explicit string columns: no numeric inference ("03" stays "03") and empty answers stay ""
+    df = pacsv.read_csv(
+        str(student_csv_path),
+        convert_options=pacsv.ConvertOptions(column_types=STUDENT_CSV_TYPES, strings_can_be_null=False),
+    ).to_pandas()
 
     q_to_points = {qid: [] for qid in df['question_id'].unique()}
     for point in meta:
@@ -117,23 +269,73 @@ def score_answers(student_csv_path: Path, scheme_artifacts_dir: Path, output_csv
         if qid in q_to_points:
             q_to_points[qid].append(point)
 
-    results = []
+    system_prompts = {qid: _build_system_prompt(qid, pts) for qid, pts in q_to_points.items() if pts}
+    max_marks = {qid: sum(p.get('marks', 1) for p in pts) for qid, pts in q_to_points.items()}
+
+    # Group answers by question so consecutive requests share the same prompt prefix;
+    # `positions` keeps each row's place in the CSV so results are written back in that order
+    df = df.reset_index(drop=True)
+    rows, positions, res_jsons, qid_rows = [], [], [], {}
+    for qid, sub in df.groupby('question_id', sort=False):
+        start = len(rows)
+        rows.extend(sub.to_dict('records'))
+        positions.extend(sub.index)
+        if qid in system_prompts:
+            qid_rows[qid] = list(range(start, len(rows)))
+            res_jsons.extend([None] * len(sub))
+        else:
+            res_jsons.extend(
+                {"marks_awarded": "N/A", "confidence_score": 0.0, "justification": "No marking scheme points found for this question ID."}
+                for _ in range(len(sub))
+            )
+
+    # Answers close to an already-scored one reuse its result instead of calling the LLM
+    cache_dir = output_csv_path.parent / SEMANTIC_CACHE_DIR
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    semantic_caches = {}   # qid -> (index, cached_results, index_path, results_path)
+    pending, prompts, pending_embs, followers = [], [], [], {}
+    for qid, idxs in qid_rows.items():
+        embeddings = _embed_answers([rows[i]["answer_text"] for i in idxs])
+        index_path, results_path = _semantic_cache_paths(cache_dir, qid, system_prompts[qid], OLLAMA_MODELS[0])
+        index, cached_results = _load_semantic_cache(index_path, results_path, embeddings.shape[1])
+        semantic_caches[qid] = (index, cached_results, index_path, results_path)
+        for i, (action, value), emb in zip(idxs, _plan_with_semantic_cache(index, cached_results, embeddings), embeddings):
+            if action == "cached":
+                res_jsons[i] = _reuse_result(value)
+            elif action == "same_as":
+                followers[i] = idxs[value]
+            else:
+                pending.append(i)
+                pending_embs.append(emb)
+                prompts.append(_build_messages(system_prompts[qid], rows[i]["answer_text"]))
+    n_reused = sum(len(idxs) for idxs in qid_rows.values()) - len(prompts)
+    if n_reused:
+        st.write(f"-> Reusing scores for {n_reused} near-duplicate answer(s).")
+
     progress_bar = st.progress(0, text="Scoring answers...")
+    done = [len(rows) - len(pending)]
 
-    for i, row in enumerate(df.itertuples()):
-        qid = str(row.question_id)
-        ans_text = row.answer_text
+    def on_done(j, result):
+        done[0] += 1
+        qid = rows[pending[j]]["question_id"]
+        progress_bar.progress(done[0] / len(rows), text=f"Scoring Question {qid}...")
 
-        scheme_points = q_to_points.get(qid, [])
-        max_marks = sum(p.get('marks', 1) for p in scheme_points)
+    if prompts:
+        model_info_placeholder.info(f"Scoring {len(prompts)} answer(s) with Ollama (models: {', '.join(OLLAMA_MODELS)})...")
+        try:
+            with requests.Session() as session:
+                outputs = asyncio.run(_run_prompts(session, OLLAMA_MODELS, prompts, on_done))
+        except OllamaUnavailable:
+            st.error(f"Could not reach Ollama at {OLLAMA_URL}. Ensure Ollama is installed and running (`ollama serve`).")
+            st.stop()
 
-        res_json = {}
-        if not scheme_points:
-            res_json = {"marks_awarded": "N/A", "confidence_score": 0.0, "justification": "No marking scheme points found for this question ID."}
-        else:
-            prompt = _build_prompt(qid, scheme_points, ans_text)
-            llm_output, used_model = _ollama_chat_with_fallback(ollama_model_list, model_info_placeholder, prompt)
-            
+        used_models, errors = set(), set()
+        pending_models = [used_model for _, used_model, _ in outputs]
+        for i, (llm_output, used_model, error) in zip(pending, outputs):
+            if used_model:
+                used_models.add(used_model)
+            if error:
+                errors.add(error)
             if llm_output:
                 res_json = _robust_json_parser(llm_output)
                 if "error" in res_json:
@@ -141,17 +343,40 @@ def score_answers(student_csv_path: Path, scheme_artifacts_dir: Path, output_csv
                     res_json['justification'] = f"Failed to parse LLM output: {res_json.get('raw_output', '')}"
             else:
                 res_json = {"marks_awarded": "Error", "justification": f"Ollama model ({used_model}) did not return a response."}
+            res_jsons[i] = res_json
+
+        # Remember the successfully scored answers for later runs
+        updated = set()
+        for i, emb, used_model in zip(pending, pending_embs, pending_models):
+            res_json = res_jsons[i]
+            if used_model != OLLAMA_MODELS[0] or "error" in res_json or res_json.get("marks_awarded") == "Error":
+                continue
+            qid = rows[i]["question_id"]
+            index, cached_results, _, _ = semantic_caches[qid]
+            index.add(emb.reshape(1, -1))
+            cached_results.append(res_json)
+            updated.add(qid)
+        for qid in updated:
+            _save_semantic_cache(*semantic_caches[qid])
+
+        for error in sorted(errors):
+            st.error(error)
+        if used_models:
+            model_info_placeholder.success(f"Successfully used model(s): {', '.join(f'`{m}`' for m in sorted(used_models))}")
+
+    for i, leader in followers.items():
+        res_jsons[i] = _reuse_result(res_jsons[leader])
 
-        results.append({
-            "student_id": row.student_id,
-            "question_id": qid,
-            "marks_awarded": res_json.get("marks_awarded"),
-            "max_marks": max_marks,
-            "confidence_score": res_json.get("confidence_score", 0.0),
-            "justification": res_json.get("justification")
-        })
-        
-        progress_bar.progress((i + 1) / len(df), text=f"Scoring Question {qid}...")
-
-    pd.DataFrame(results).to_csv(output_csv_path, index=False)
+    results = [
+        {
+            "student_id": row["student_id"],
+            "question_id": row["question_id"],
+            "marks_awarded": None if res_json.get("marks_awarded") is None else str(res_json["marks_awarded"]),
+            "max_marks": max_marks[row["question_id"]],
+            "confidence_score": _as_float(res_json.get("confidence_score", 0.0)),
+            "justification": None if res_json.get("justification") is None else str(res_json["justification"]),
+        }
+        for _, row, res_json in sorted(zip(positions, rows, res_jsons), key=lambda item: item[0])
+    ]
+    pacsv.write_csv(pa.Table.from_pylist(results, schema=RESULT_SCHEMA), str(output_csv_path))
     progress_bar.empty()